@@ -1,15 +1,25 @@
 import csv
+from bisect import bisect_right
 from datetime import datetime, timedelta
+from functools import lru_cache
 import sys
 import os
 import argparse
 import json
 from typing import List, Tuple
 
+try:
+    import orjson
+except ImportError:
+    # orjson is optional, the standard json module is used without it
+    orjson = None
+
 
 DATE_COLUMN = 0
 TIME_COLUMN = 1
 CATEGORIZATION_COLUMN = 2
+# intensity cells look like " Intensity: 3", the number starts right after this prefix
+INTENSITY_PREFIX_LENGTH = len(" Intensity: ")
 
 
 class Config:
@@ -24,8 +34,9 @@ class Config:
         args = self._parse_arguments(default_json)
         self.input_file = args.input_file
         self.output_file = args.output_file
-        self.consumables = args.consumables
-        self.symptoms = args.symptoms
+        # stored as sets since they are only used for membership checks
+        self.consumables = frozenset(args.consumables)
+        self.symptoms = frozenset(args.symptoms or ())
         self.min_times_consumed = args.min_times_consumed
         self.symptom_warning_score = args.symptom_warning_score
         # change integer into a timedelta object to use for time comparison later
@@ -73,11 +84,13 @@ class MySymptomsCSV:
         Get settings from config object and initialize dicts.
         If include_symptoms is empty, then all symptoms will be included in the analysis.
         '''
-        self.include_symptoms = include_symptoms
+        self.include_symptoms = frozenset(include_symptoms) if include_symptoms else None
         self.symptom_onset_hours = symptom_onset_hours
-        self.valid_consumables = consumables
+        self.valid_consumables = frozenset(consumables)
         self.consumables = {} # name : consumable objext
-        self.symptoms = {} # name : symptom object
+        self.symptoms = set() # symptom names
+        # (date, row_index, occurences) for each symptom entry, matched to consumables once the whole file has been read
+        self._symptom_entries = []
 
     def import_file(self, input_file: str) -> None:
         """
@@ -86,63 +99,97 @@ class MySymptomsCSV:
         with open(input_file) as csvfile:
             filereader = csv.reader(csvfile)
             next(filereader)  # skip header
+            consumable_categories = self.valid_consumables
 
-            for row in filereader:
-                datetime = convert_to_date_time(
-                    row[DATE_COLUMN], row[TIME_COLUMN])
+            # the row index breaks ties between entries logged in the same minute, in file order
+            for row_index, row in enumerate(filereader):
                 category = clean_data(row[CATEGORIZATION_COLUMN])
 
-                if category in config.consumables:
-                    self._update_consumables(row, datetime)
+                # only parse the date for rows that are part of the analysis
+                if category in consumable_categories:
+                    datetime = convert_to_date_time(row[DATE_COLUMN], row[TIME_COLUMN])
+                    self._update_consumables(row, datetime, row_index)
+                elif category == "Symptom":
+                    datetime = convert_to_date_time(row[DATE_COLUMN], row[TIME_COLUMN])
+                    self._update_symptoms(row, datetime, row_index)
 
-                if category == "Symptom":
-                    self._update_symptoms(row, datetime)
+        self._match_symptoms()
 
-    def _update_consumables(self, row: list, datetime: datetime) -> None:
+    def _update_consumables(self, row: list, datetime: datetime, row_index: int) -> None:
         """
         Updates or creates a new object for each consumable from a single entry of consumables.
         CSV row example - 03/30/2022, 18:57, Dinner, "Sushi, Cucumber Rolls", "Seaweed", "Cucumber", "White rice"
         """
+        consumables = self.consumables
+
         # each column after the categorization column will be a consumable or a specified amount of a consumable (the amounts will be ignored)
         for i in range(CATEGORIZATION_COLUMN + 1, len(row)):
-            item = clean_data(row[i])
+            # same as clean_data, inlined to save a function call for every cell
+            item = row[i].strip(" ").replace('"', "")
             if ignore_item(item):
                 continue
 
-            if item in self.consumables:
-                consumable = self.consumables[item]
-                consumable.update_last_consumed(datetime)
+            consumable = consumables.get(item)
+            if consumable is not None:
+                consumable.update_last_consumed(datetime, row_index)
             else:
-                self.consumables[item] = Consumable(item, datetime)
-
+                consumable = Consumable(item, datetime, row_index)
+                consumables[item] = consumable
 
-    def _update_symptoms(self, row: list, datetime: datetime) -> None:
+    def _update_symptoms(self, row: list, datetime: datetime, row_index: int) -> None:
         """
-        Updates or creates a new object for each symptom from a single entry of symptoms.
-        Connects an occurence of a symptom to a consumable if the symptom occurred within the 
-        symptom_onset_hours.
+        Creates an occurence for each symptom from a single entry of symptoms.
+        The occurences are connected to consumables by _match_symptoms after the whole file is read.
         """
-        for consumable in self.consumables.values():
-            if not (datetime - consumable.last_consumed) < self.symptom_onset_hours:
+        include_symptoms = self.include_symptoms
+        symptoms = self.symptoms
+
+        # each symptom row is in the format [symptom, intensity, symptom, intensity, ...]
+        # the row is parsed once into (symptom, intensity) pairs that are shared by every matching consumable
+        occurences = []
+        cells = row[CATEGORIZATION_COLUMN + 1:]
+        for symptom_cell, intensity_cell in zip(cells[::2], cells[1::2]):
+            # same as clean_data, inlined to save a function call for every cell
+            symptom_name = sys.intern(symptom_cell.strip(" ").replace('"', ""))
+
+            # ignore duration values and only analyze specified symptoms
+            if symptom_name.startswith("Duration") or (include_symptoms is not None and symptom_name not in include_symptoms):
                 continue
 
-            # each symptom row is in the format [symptom, intensity, symptom, intensity, ...]
-            for i in range(CATEGORIZATION_COLUMN + 1, len(row), 2):
-                symptom_name = clean_data(row[i])
+            symptom_intensity = int(intensity_cell[INTENSITY_PREFIX_LENGTH:])
 
-                # ignore duration values and only analyze specified symptoms
-                if symptom_name.startswith("Duration") or (self.include_symptoms and symptom_name not in self.include_symptoms):
-                    continue
+            symptoms.add(symptom_name)
+            occurences.append((symptom_name, symptom_intensity))
+
+        if occurences:
+            self._symptom_entries.append((datetime, row_index, occurences))
 
-                symptom_intensity = int(row[i + 1].replace(" Intensity: ", ""))
+    def _match_symptoms(self) -> None:
+        """
+        Connects each symptom entry to every consumable whose most recent consumption before the symptom happened within the
+        symptom_onset_hours. All consumptions are sorted by (date, row_index) first, so the rows of the file don't need to be in
+        order, and entries logged in the same minute only count as before the symptom if they come earlier in the file.
+        """
+        consumptions = sorted(((date, row_index, consumable) for consumable in self.consumables.values() for date, row_index in consumable.consumptions),
+                              key=lambda consumption: consumption[:2])
+        consumption_dates = [date for date, _, _ in consumptions]
+        consumption_keys = [(date, row_index) for date, row_index, _ in consumptions]
+
+        for datetime, row_index, occurences in self._symptom_entries:
+            # binary search for the consumptions after datetime - symptom_onset_hours and before the symptom entry
+            start = bisect_right(consumption_dates, datetime - self.symptom_onset_hours)
+            end = bisect_right(consumption_keys, (datetime, row_index))
+
+            matched = set()
+            for _, _, consumable in consumptions[start:end]:
+                # a consumable eaten more than once in the window is only connected once
+                if consumable.name in matched:
+                    continue
+                matched.add(consumable.name)
 
-                if symptom_name in self.symptoms:
-                    symptom = self.symptoms[symptom_name]
-                else:
-                    symptom = Symptom(symptom_name)
-                    self.symptoms[symptom_name] = symptom
-                occurence = SymptomOccurence(symptom, datetime, symptom_intensity)
-                consumable.add_symptom_occurence(occurence)
+                for symptom_name, symptom_intensity in occurences:
+                    consumable.add_symptom_occurence(symptom_name, symptom_intensity)
+        self._symptom_entries = []
 
 
 def clean_data(data: str) -> str:
@@ -150,11 +197,21 @@ def clean_data(data: str) -> str:
     return data.strip(" ").replace('"', "")
 
 
+@lru_cache(maxsize=8192)
 def convert_to_date_time(date: str, time: str) -> object:
-    """ converts date and time strings into one datetime object """
-    datetime_string = clean_data(date + time)
-    datetime_obj = datetime.strptime(datetime_string, "%m/%d/%Y %H:%M")
-    return datetime_obj
+    """ converts date and time strings into one datetime object. Entries logged in the same minute share a cached result. """
+    return _fast_parse(clean_data(date), clean_data(time))
+
+
+def _fast_parse(date: str, time: str) -> datetime:
+    """ builds a datetime from fixed width MM/DD/YYYY and HH:MM strings without going through strptime """
+    fields = (date[0:2], date[3:5], date[6:10], time[0:2], time[3:5])
+    is_fixed_width = len(date) == 10 and len(time) == 5 and date[2] == date[5] == "/" and time[2] == ":"
+    if not is_fixed_width or not all(field.isdigit() for field in fields):
+        # not zero padded or not the expected format, let strptime parse it or raise
+        return datetime.strptime(date + " " + time, "%m/%d/%Y %H:%M")
+    month, day, year, hour, minute = fields
+    return datetime(int(year), int(month), int(day), int(hour), int(minute))
 
 
 def ignore_item(item: str) -> bool:
@@ -162,50 +219,32 @@ def ignore_item(item: str) -> bool:
     return item.startswith("[")
 
 
-class Symptom:
-    """
-    Currently only stores the symptom name
-    """
-    def __init__(self, name: str) -> None:
-        self.name = name
-
-
-class SymptomOccurence:
-    """
-    A single entry of a symptom and its intensity. Tagged with the date so we can correlate this occurence with the ingestion of a consumable.
-    """
-    def __init__(self, symptom: Symptom, date: datetime, intensity: int) -> None:
-        self.symptom = symptom
-        self.date = date
-        self.intensity = intensity
-
-
 class Consumable:
     """
-    Has a list of symptoms
+    Has the running intensity totals of the symptoms that followed it
     """
+    __slots__ = ("name", "consumptions", "times_consumed", "_symptom_totals")
 
-    def __init__(self, name: str, last_consumed: datetime) -> None:
+    def __init__(self, name: str, date: datetime, row_index: int) -> None:
         self.name = name
-        self.last_consumed = last_consumed
+        # (date, row_index) pairs in file order, MySymptomsCSV._match_symptoms sorts all consumptions together before matching
+        self.consumptions = [(date, row_index)]
         self.times_consumed = 1
-        self.symptom_occurrences = []
-        self.associated_symptoms = set()
+        self._symptom_totals = {} # symptom name : sum of its intensities
 
-    def update_last_consumed(self, date: datetime):
-        self.last_consumed = date
+    def update_last_consumed(self, date: datetime, row_index: int):
+        self.consumptions.append((date, row_index))
         self.times_consumed += 1
 
-    def add_symptom_occurence(self, occurence: SymptomOccurence) -> None:
-        self.associated_symptoms.add(occurence.symptom)
-        self.symptom_occurrences.append(occurence)
+    def add_symptom_occurence(self, symptom_name: str, intensity: int) -> None:
+        self._symptom_totals[symptom_name] = self._symptom_totals.get(symptom_name, 0) + intensity
 
     def total_danger_score(self) -> float:
         """ calculates the average intensity of a symptom (1-10) after the given item has been consumed.
         Gives a warning for concerning symptoms.
         """
         # calculate symptom score for consumable
-        total_symptom_intensity = sum([symptom.intensity for symptom in self.symptom_occurrences])
+        total_symptom_intensity = sum(self._symptom_totals.values())
 
         average_symptom_intensity = total_symptom_intensity / \
             self.times_consumed if total_symptom_intensity else 0
@@ -216,15 +255,11 @@ class Consumable:
         Gives a warning for concerning symptoms.
         """
         symptom_scores = {}
-        for symptom in self.associated_symptoms:
-            symptom_score = sum([occurence.intensity for occurence in self.symptom_occurrences if occurence.symptom == symptom])
-            if symptom_score:
-                average_symptom_score = round(symptom_score/self.times_consumed, 2) if symptom_score else 0
-            else: 
-                average_symptom_score = 0
-            symptom_scores[symptom.name] = average_symptom_score
+        for symptom_name, symptom_score in self._symptom_totals.items():
+            average_symptom_score = round(symptom_score/self.times_consumed, 2) if symptom_score else 0
+            symptom_scores[symptom_name] = average_symptom_score
             if average_symptom_score > warning_threshold:
-                print("warning!", self.name, symptom.name, average_symptom_score)
+                print("warning!", self.name, symptom_name, average_symptom_score)
         return symptom_scores
 
 
@@ -247,9 +282,17 @@ def calculate_safest_consumables(consumables: list, min_times_consumed: int, war
 
 def save_to_file(data: object, output_file: str):
     """creates a file and writes the given json data into it"""
+    if orjson is not None:
+        with open(output_file, "wb") as json_file:
+            json_file.write(orjson.dumps(data, option=orjson.OPT_INDENT_2))
+        return
+
     with open(output_file, "w") as json_file:
-        json.dump(data, json_file, indent=4, default=vars)
+        json.dump(data, json_file, indent=4)
 
+# The script is mostly string and date parsing, which runs well under PyPy. orjson is not available there,
+# so the standard json module is used automatically:
+#   pypy3 mysymptoms.py -i mySymptomsDiary.csv -o consumable_scores.json
 if __name__ == "__main__":
     config = Config()
     csv_data = MySymptomsCSV(config.symptoms, config.symptom_onset_hours, config.consumables)